@@ -1,8 +1,22 @@
 import os
 import json
+import io
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import base64
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+from fnmatch import fnmatch
+import time
+import hashlib
+from collections import namedtuple
+
+try:
+    import orjson
+    json_loads = orjson.loads  # several times faster on large GraphQL/Gemini payloads
+except ImportError:
+    json_loads = json.loads
 
 # --- ENVIRONMENT VARIABLES ---
 GITHUB_TOKEN = os.environ["GITHUB_TOKEN"]
@@ -13,17 +27,66 @@ GITHUB_EVENT_PATH = os.environ["GITHUB_EVENT_PATH"]
 BASE_COMMIT_SHA = os.getenv("BASE_SHA")
 HEAD_COMMIT_SHA = os.getenv("GITHUB_SHA")
 
+# --- SHARED HTTP SESSION ---
+# One pooled session keeps TLS connections to GitHub and Gemini alive
+# across all calls instead of reconnecting per request.
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    # Gemini's per-minute quota and GitHub's rate limit both answer 429 with a
+    # Retry-After. POST is retried too: generateContent is the call that hits
+    # the quota, and it and the GraphQL query have no side effects. The one
+    # POST that does (creating the PR review) gets its own adapter below.
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "HEAD", "POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False  # hand the last response back so status checks below still apply
+    )
+)
+session.mount("https://", adapter)
+
+# --- ON-DISK CACHES ---
+# Persist CACHE_DIR with actions/cache to share caches between workflow runs.
+CACHE_DIR = os.getenv(
+    "REVIEW_CACHE_DIR",
+    os.path.join(os.getenv("RUNNER_TEMP", "/tmp"), "gemini-review-cache")
+)
+
+
+def load_json_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json_cache(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
 
 # --- LOAD PR EVENT TO GET BASE SHA ---
 with open(GITHUB_EVENT_PATH) as f:
     event_data = json.load(f)
 
 BASE_SHA = event_data["pull_request"]["base"]["sha"]
+PR_HEAD_SHA = event_data["pull_request"]["head"]["sha"]
 
 # --- FETCH DIFF FOR SPECIFIC COMMIT (OR FULL PR IF FIRST RUN) ---
 diff_headers = {
     "Authorization": f"token {GITHUB_TOKEN}",
-    "Accept": "application/vnd.github.v3.diff"
+    "Accept": "application/vnd.github.v3.diff",
+    # requests sends this by default; set it explicitly so it survives proxies
+    # that rewrite headers around a custom Accept. Diffs compress ~10x.
+    "Accept-Encoding": "gzip"
 }
 
 if BASE_COMMIT_SHA:
@@ -35,75 +98,231 @@ else:
     diff_url = f"https://api.github.com/repos/{REPO}/pulls/{PR_NUMBER}"
     print("BASE_SHA not found — reviewing full PR diff.")
 
-diff_resp = requests.get(diff_url, headers=diff_headers)
-if diff_resp.status_code != 200:
-    print(f"Failed to fetch diff: {diff_resp.status_code} {diff_resp.text}")
-    exit(1)
+# --- PARSE DIFF WITH LINE NUMBERS ---
+# One record per changed line; a tuple is far smaller than a 4-key dict on large diffs.
+Change = namedtuple("Change", "type old_line new_line content")
+
+hunk_regex = re.compile(r"@@ -(\d+),?\d* \+(\d+),?\d* @@")
 
-raw_diff = diff_resp.text
 
-if not raw_diff.strip():
+def parse_diff(lines):
+    """Parse unified diff lines in one pass.
+
+    Returns ``(pr_diff, pr_context)``: ``pr_diff`` maps each file path to its
+    ``Change`` records; ``pr_context`` keeps the hunk headers and unchanged
+    lines, used as base context so the full base file only has to be
+    downloaded when the diff carries too little.
+    """
+    pr_diff = {}
+    pr_context = {}
+    current_file = None
+    changes = context = None  # lists of the current file
+    old_line_num = new_line_num = 0
+
+    # Branch on the first character once; the longer "+++ b/" / "---" header
+    # prefixes are only checked for lines that already start with +/-. Other
+    # lines (diff/index headers, "\ No newline at end of file") do not move
+    # the line counters.
+    for line in lines:
+        first = line[:1]
+        if first == "+":
+            if line.startswith("+++"):
+                if line.startswith("+++ b/"):
+                    current_file = line[6:].strip()
+                    if current_file not in pr_diff:
+                        pr_diff[current_file] = []
+                        pr_context[current_file] = []
+                    changes = pr_diff[current_file]
+                    context = pr_context[current_file]
+            elif current_file:
+                changes.append(Change("added", None, new_line_num, line[1:]))
+                new_line_num += 1
+        elif first == "-":
+            if current_file and not line.startswith("---"):
+                changes.append(Change("deleted", old_line_num, None, line[1:]))
+                old_line_num += 1
+        elif first == " " or not first:
+            if current_file:
+                if first:
+                    context.append(f"[L{new_line_num}] {line[1:]}")
+                old_line_num += 1
+                new_line_num += 1
+        elif first == "@":
+            if current_file:
+                context.append(line)
+                match = hunk_regex.match(line)
+                if match:
+                    old_line_num = int(match.group(1))
+                    new_line_num = int(match.group(2))
+    return pr_diff, pr_context
+
+
+# A HEAD request answers "is there anything to review?" without downloading
+# the diff, so no-op pushes exit early.
+head_resp = session.head(diff_url, headers=diff_headers)
+if head_resp.status_code == 200 and head_resp.headers.get("Content-Length") == "0":
     print("No diff detected between commits — skipping review.")
     exit(0)
 
-# --- PARSE DIFF WITH LINE NUMBERS ---
-pr_diff = {}  # { file_path: [ {type, old_line, new_line, content} ] }
-current_file = None
-old_line_num = new_line_num = 0
-
-hunk_regex = re.compile(r"@@ -(\d+),?\d* \+(\d+),?\d* @@")
-for line in raw_diff.splitlines():
-    if line.startswith("+++ b/"):
-        current_file = line.replace("+++ b/", "").strip()
-        if current_file not in pr_diff:
-            pr_diff[current_file] = []
-    elif current_file and line.startswith("@@"):
-        match = hunk_regex.match(line)
-        if match:
-            old_line_num = int(match.group(1))
-            new_line_num = int(match.group(2))
-    elif current_file:
-        if line.startswith("+") and not line.startswith("+++"):
-            pr_diff[current_file].append({
-                "type": "added",
-                "old_line": None,
-                "new_line": new_line_num,
-                "content": line[1:]
-            })
-            new_line_num += 1
-        elif line.startswith("-") and not line.startswith("---"):
-            pr_diff[current_file].append({
-                "type": "deleted",
-                "old_line": old_line_num,
-                "new_line": None,
-                "content": line[1:]
-            })
-            old_line_num += 1
-        else:
-            old_line_num += 1
-            new_line_num += 1
+# The diff is streamed into the parser line by line, so parsing overlaps the
+# download and the raw text is never held in memory in full.
+with session.get(diff_url, headers=diff_headers, stream=True) as diff_resp:
+    if diff_resp.status_code != 200:
+        print(f"Failed to fetch diff: {diff_resp.status_code} {diff_resp.text}")
+        exit(1)
+    if diff_resp.headers.get("Content-Encoding") != "gzip":
+        print("Diff response is not gzip-compressed.")
+    # iter_lines() yields a spurious "" when a chunk boundary splits "\r\n",
+    # which would shift line numbers; TextIOWrapper's universal newlines
+    # treat "\r\n", "\r" and "\n" as one line break even across reads.
+    diff_resp.raw.decode_content = True
+    diff_resp.raw.auto_close = False  # TextIOWrapper closes it itself
+    # Diffs of Latin-1 or binary-ish files are not valid UTF-8; replace the bad
+    # bytes rather than abort the whole review.
+    diff_stream = io.TextIOWrapper(diff_resp.raw, encoding="utf-8", errors="replace")
+    pr_diff, pr_context = parse_diff(line.rstrip("\n") for line in diff_stream)
+
+if not pr_diff:
+    print("No diff detected between commits — skipping review.")
+    exit(0)
 
 # --- FETCH BASE FILE CONTENTS ---
+# { url: {etag, content, expires} } — conditional GETs answered with 304 cost
+# no primary rate limit and return the stored content. URLs embed BASE_SHA, so
+# entries stop matching once the base moves; the TTL keeps them from piling up.
+ETAG_CACHE_PATH = os.path.join(CACHE_DIR, "etags.json")
+ETAG_CACHE_TTL = 7 * 86400
+etag_cache = {
+    url: entry
+    for url, entry in load_json_cache(ETAG_CACHE_PATH).items()
+    if isinstance(entry, dict) and entry.get("expires", 0) > time.time()
+}
+
+
 def get_base_file_content(file_path):
     url = f"https://api.github.com/repos/{REPO}/contents/{file_path}?ref={BASE_SHA}"
-    resp = requests.get(url, headers={"Authorization": f"token {GITHUB_TOKEN}"})
+    # The raw media type returns the file itself: no JSON wrapper, no base64.
+    headers = {
+        "Authorization": f"token {GITHUB_TOKEN}",
+        "Accept": "application/vnd.github.raw"
+    }
+    cached = etag_cache.get(url)
+    if cached:
+        headers["If-None-Match"] = cached["etag"]
+    resp = session.get(url, headers=headers)
+    if resp.status_code == 304 and cached:
+        cached["expires"] = time.time() + ETAG_CACHE_TTL
+        return cached["content"]
     if resp.status_code != 200:
         print(f"Failed to fetch base content for {file_path}: {resp.status_code}")
         return ""
-    data = resp.json()
-    content = base64.b64decode(data["content"]).decode("utf-8")
+    resp.encoding = "utf-8"
+    content = resp.text
+    if "ETag" in resp.headers:
+        etag_cache[url] = {
+            "etag": resp.headers["ETag"],
+            "content": content,
+            "expires": time.time() + ETAG_CACHE_TTL
+        }
     return content
 
+
+# Above this share of changed lines the diff's own context is too thin to
+# review against, so the full base file is fetched.
+FULL_FETCH_CHANGE_RATIO = 0.6
+
+
+def should_fetch_full(file_changes, context_lines):
+    unchanged = sum(1 for line in context_lines if not line.startswith("@@"))
+    if not unchanged and all(c.type == "added" for c in file_changes):
+        return False  # new file: nothing to fetch from the base commit
+    return len(file_changes) / (len(file_changes) + unchanged) > FULL_FETCH_CHANGE_RATIO
+
+
+# Base files are fetched in one GraphQL query (aliases f0, f1, ...) instead of
+# one REST call each. Blobs GraphQL only returns truncated fall back to REST.
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_BATCH_SIZE = 100
+REPO_OWNER, REPO_NAME = REPO.split("/", 1)
+
+
+def fetch_base_contents(file_paths):
+    var_defs = "".join(f", $e{i}: String!" for i in range(len(file_paths)))
+    fields = "\n".join(
+        f"f{i}: object(expression: $e{i}) {{ ... on Blob {{ text isTruncated }} }}"
+        for i in range(len(file_paths))
+    )
+    query = (
+        f"query($owner: String!, $name: String!{var_defs}) {{\n"
+        f"  repository(owner: $owner, name: $name) {{\n{fields}\n  }}\n}}"
+    )
+    variables = {"owner": REPO_OWNER, "name": REPO_NAME}
+    for i, file_path in enumerate(file_paths):
+        variables[f"e{i}"] = f"{BASE_SHA}:{file_path}"
+
+    resp = session.post(
+        GRAPHQL_URL,
+        headers={"Authorization": f"bearer {GITHUB_TOKEN}"},
+        json={"query": query, "variables": variables}
+    )
+    if resp.status_code != 200:
+        print(f"Failed to fetch base contents via GraphQL: {resp.status_code}")
+        return {}
+    resp_json = json_loads(resp.content)
+    repository = (resp_json.get("data") or {}).get("repository")
+    if resp_json.get("errors") or repository is None:
+        # e.g. a permission or expression error on an HTTP 200: let every
+        # file fall back to REST rather than treating it as absent.
+        print(f"GraphQL base content query failed: {resp_json.get('errors')}")
+        return {}
+
+    contents = {}
+    for i, file_path in enumerate(file_paths):
+        alias = f"f{i}"
+        if alias not in repository:
+            continue  # not answered: fetched through REST instead
+        blob = repository[alias]
+        if blob is None:
+            contents[file_path] = ""  # file does not exist at the base commit
+        elif blob.get("text") is not None and not blob.get("isTruncated"):
+            contents[file_path] = blob["text"]
+    return contents
+
+
+async def load_base_contents(file_paths):
+    batches = [
+        file_paths[i:i + GRAPHQL_BATCH_SIZE]
+        for i in range(0, len(file_paths), GRAPHQL_BATCH_SIZE)
+    ]
+    contents = {}
+    for batch_contents in await asyncio.gather(*(
+        asyncio.to_thread(fetch_base_contents, batch) for batch in batches
+    )):
+        contents.update(batch_contents)
+
+    missing = [file_path for file_path in file_paths if file_path not in contents]
+    fetched = await asyncio.gather(*(
+        asyncio.to_thread(get_base_file_content, file_path) for file_path in missing
+    ))
+    contents.update(zip(missing, fetched))
+    return contents
+
 # --- PROMPT TEMPLATE ---
-PROMPT_TEMPLATE = """
+# Split so the batched prompt can repeat the per-file parts once per file
+# while sending the review instructions only once.
+CONTEXT_TEMPLATE = """
 File: {file_path}
 
 Base code (for context):
 {base_content}
+"""
 
+CHANGES_TEMPLATE = """
 Changes (changes made in this pull request with line numbers):
 {diff_lines}
+"""
 
+REVIEW_INSTRUCTIONS = """
 You are a senior engineer reviewing a pull request. Focus ONLY on the changes introduced in this diff.
 
 ### What to Look For when reviewing
@@ -168,32 +387,37 @@ Follow this format:
 
 """
 
-GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
-review_comments = []
+PROMPT_TEMPLATE = CONTEXT_TEMPLATE + CHANGES_TEMPLATE + REVIEW_INSTRUCTIONS
 
-# --- LOOP FILES & SEND TO GEMINI ---
-for file_path, changes in pr_diff.items():
-    if not changes:
-        continue
+# Bump whenever PROMPT_TEMPLATE or the model changes so cached reviews are not reused.
+PROMPT_VERSION = "1"
 
-    base_content = get_base_file_content(file_path)
+# Streamed as server-sent events: each "data:" line is a partial response
+# whose text parts are appended as they arrive.
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:streamGenerateContent?alt=sse"
+REVIEWS_URL = f"https://api.github.com/repos/{REPO}/pulls/{PR_NUMBER}/reviews"
 
-    # Build diff string with inline line numbers
-    diff_lines = []
-    for c in changes:
-        if c["type"] == "added":
-            diff_lines.append(f"+ [L{c['new_line']}] {c['content']}")
-        elif c["type"] == "deleted":
-            diff_lines.append(f"- [L{c['old_line']}] {c['content']}")
-    diff_text = "\n".join(diff_lines)
+# --- REVIEW CACHE ---
+# Reviews are keyed by everything that goes into the prompt, so reruns on the
+# same (base, diff) pair skip Gemini.
+REVIEW_CACHE_PATH = os.path.join(CACHE_DIR, "reviews.json")
+REVIEW_CACHE_TTL = 7 * 86400
 
-    prompt = PROMPT_TEMPLATE.format(
-        file_path=file_path,
-        base_content=base_content,
-        diff_lines=diff_text
-    )
 
-    # Call Gemini
+def review_cache_key(file_path, base_content, diff_text):
+    raw = f"{PROMPT_VERSION}|{file_path}|{base_content}|{diff_text}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+now = time.time()
+review_cache = {
+    key: entry
+    for key, entry in load_json_cache(REVIEW_CACHE_PATH).items()
+    if entry.get("expires", 0) > now
+}
+
+# --- BUILD PROMPT & SEND TO GEMINI ---
+def call_gemini(prompt, generation_config=None):
     headers = {
         "Content-Type": "application/json",
         "X-goog-api-key": GEMINI_API_KEY
@@ -203,29 +427,386 @@ for file_path, changes in pr_diff.items():
             {"parts": [{"text": prompt}]}
         ]
     }
-    resp = requests.post(GEMINI_URL, headers=headers, json=payload)
-    resp_json = resp.json()
-    ai_comment = (
-        resp_json.get("candidates", [{}])[0]
-            .get("content", {})
-            .get("parts", [{}])[0]
-            .get("text", "No response from Gemini.")
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    with session.post(GEMINI_URL, headers=headers, json=payload, stream=True) as resp:
+        if resp.status_code != 200:
+            raise RuntimeError(f"Gemini request failed: {resp.status_code} {resp.text}")
+        resp.encoding = "utf-8"
+        texts = []
+        finish_reason = None
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line.startswith("data:"):
+                continue
+            chunk = json_loads(line[5:])
+            if "error" in chunk:
+                raise RuntimeError(f"Gemini stream failed: {chunk['error']}")
+            candidates = chunk.get("candidates")
+            if not candidates:
+                continue  # e.g. a trailing usage-metadata-only chunk
+            finish_reason = candidates[0].get("finishReason", finish_reason)
+            for part in candidates[0].get("content", {}).get("parts", []):
+                texts.append(part.get("text", ""))
+    if not texts:
+        raise RuntimeError(f"Gemini returned no text (finishReason={finish_reason})")
+    return "".join(texts)
+
+
+async def review_file(file):
+    # A failure here (quota still exhausted after retries, a blocked prompt)
+    # only drops this file, so the reviews that did succeed are still posted.
+    prompt = PROMPT_TEMPLATE.format(
+        file_path=file["path"],
+        base_content=file["base_content"],
+        diff_lines=file["diff_text"]
     )
+    try:
+        return await asyncio.to_thread(call_gemini, prompt)
+    except (RuntimeError, ValueError, requests.RequestException) as e:
+        print(f"Skipping review for {file['path']}: {e}")
+        return None
+
+
+# --- BATCHED REVIEW ---
+# Files are reviewed together in one request that returns a JSON list
+# of per-file reviews; batches are capped to stay within the output limit.
+BATCH_SIZE = 10
+
+BATCH_PROMPT_TEMPLATE = """
+This pull request changes the files below. Each file section starts with a
+===FILE: <path>=== line. Review every file separately.
+
+{file_sections}
+""" + REVIEW_INSTRUCTIONS + """
+### Response Format
+
+Return JSON only: one entry in "reviews" per file, where "path" is the file
+path exactly as given in its ===FILE=== line and "body" is the review for
+that file in the Output Structure above, as markdown.
+"""
+
+BATCH_GENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "OBJECT",
+        "properties": {
+            "reviews": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "path": {"type": "STRING"},
+                        "body": {"type": "STRING"}
+                    },
+                    "required": ["path", "body"]
+                }
+            }
+        },
+        "required": ["reviews"]
+    }
+}
 
-    review_comments.append({
+
+def review_batch(files):
+    file_sections = "\n".join(
+        f"===FILE: {file['path']}===\n"
+        + CONTEXT_TEMPLATE.format(file_path=file["path"], base_content=file["base_content"])
+        + CHANGES_TEMPLATE.format(diff_lines=file["diff_text"])
+        for file in files
+    )
+    prompt = BATCH_PROMPT_TEMPLATE.format(file_sections=file_sections)
+    try:
+        ai_comment = call_gemini(prompt, generation_config=BATCH_GENERATION_CONFIG)
+        reviews = json_loads(ai_comment)["reviews"]
+        return {review["path"]: review["body"] for review in reviews}
+    except (RuntimeError, ValueError, KeyError, TypeError, requests.RequestException) as e:
+        print(f"Batched review for {len(files)} files failed ({e}) — reviewing them one by one.")
+        return {}
+
+
+async def review_batched(files):
+    reviews = await asyncio.to_thread(review_batch, files)
+    paths = {file["path"] for file in files}
+    reviews = {path: body for path, body in reviews.items() if path in paths}
+    missing = [file for file in files if file["path"] not in reviews]
+    bodies = await asyncio.gather(*(review_file(file) for file in missing))
+    reviews.update(
+        (file["path"], body) for file, body in zip(missing, bodies) if body is not None
+    )
+    return reviews
+
+
+# --- KEEP PROMPTS SMALL ---
+# Generated and binary files rarely benefit from review but can dominate the
+# prompt, so they are skipped entirely.
+SKIP_GLOBS = [
+    "*.lock", "package-lock.json", "pnpm-lock.yaml", "npm-shrinkwrap.json",
+    "*.min.js", "*.min.css", "*.map",
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.ico", "*.webp", "*.pdf",
+    "*.zip", "*.gz", "*.tar", "*.jar", "*.woff", "*.woff2", "*.ttf",
+    "*.exe", "*.dll", "*.so", "*.pyc"
+]
+
+# Above this size a fetched base file is cut down to the lines around the
+# changes, and diff-derived context is cut down to whole hunks.
+MAX_BASE_CHARS = 40000
+BASE_CONTEXT_LINES = 50
+
+
+def should_skip(file_path):
+    name = os.path.basename(file_path)
+    return any(fnmatch(name, pattern) for pattern in SKIP_GLOBS)
+
+
+def trim_base_content(base_content, changes):
+    if len(base_content) <= MAX_BASE_CHARS:
+        return base_content
+
+    lines = base_content.splitlines()
+    changed_lines = sorted({c.new_line or c.old_line for c in changes})
+
+    # Merge the +-BASE_CONTEXT_LINES windows (1-based, inclusive) around each change.
+    ranges = []
+    for line_num in changed_lines:
+        start = max(1, line_num - BASE_CONTEXT_LINES)
+        end = min(len(lines), line_num + BASE_CONTEXT_LINES)
+        if start > end:
+            continue  # new-file line numbers can run past the end of the base
+        if ranges and start <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+
+    kept = []
+    prev_end = 0
+    for start, end in ranges:
+        if start > prev_end + 1:
+            kept.append("... <snip> ...")
+        kept.extend(lines[start - 1:end])
+        prev_end = end
+    if prev_end < len(lines):
+        kept.append("... <snip> ...")
+    return "\n".join(kept)
+
+
+def trim_context(context_lines):
+    # The context list holds hunk headers and their unchanged lines, not file
+    # lines, so file line numbers cannot index it; keep whole hunks in diff
+    # order until the budget is spent.
+    hunks = []
+    for line in context_lines:
+        if line.startswith("@@") or not hunks:
+            hunks.append([])
+        hunks[-1].append(line)
+
+    kept = []
+    size = 0
+    for i, hunk in enumerate(hunks):
+        hunk_size = sum(len(line) + 1 for line in hunk)
+        if kept and size + hunk_size > MAX_BASE_CHARS:
+            kept.append(f"... <snip: {len(hunks) - i} more hunks> ...")
+            break
+        kept.extend(hunk)
+        size += hunk_size
+    return "\n".join(kept)
+
+
+def format_change(c):
+    if c.type == "added":
+        return f"+ [L{c.new_line}] {c.content}"
+    return f"- [L{c.old_line}] {c.content}"
+
+
+def prepare_file(file_path, changes, base_content, context_lines):
+    # The diff's own context stands in when the file was not fetched, and when
+    # the fetch came back empty (failed request, null blob, renamed path).
+    if not base_content:
+        base_content = trim_context(context_lines)
+    else:
+        base_content = trim_base_content(base_content, changes)
+
+    # Build diff string with inline line numbers
+    diff_text = "\n".join(map(format_change, changes))
+
+    return {
         "path": file_path,
-        "body": ai_comment
-    })
+        "base_content": base_content,
+        "diff_text": diff_text,
+        "key": review_cache_key(file_path, base_content, diff_text)
+    }
 
-# --- POST COMMENTS BACK TO THE PR ---
-COMMENTS_URL = f"https://api.github.com/repos/{REPO}/issues/{PR_NUMBER}/comments"
-post_headers = {
-    "Authorization": f"token {GITHUB_TOKEN}",
-    "Accept": "application/vnd.github.v3+json",
-    "Content-Type": "application/json"
+
+async def review_files(files):
+    reviews = {}
+    pending = []
+    for file in files:
+        if file["key"] in review_cache:
+            print(f"Using cached review for {file['path']}")
+            reviews[file["path"]] = review_cache[file["key"]]["body"]
+        else:
+            pending.append(file)
+
+    # Batching only pays off when there are at least two files to review.
+    single = pending if len(pending) < 2 else []
+    batched = pending if len(pending) >= 2 else []
+    batches = [batched[i:i + BATCH_SIZE] for i in range(0, len(batched), BATCH_SIZE)]
+
+    results = await asyncio.gather(
+        *(review_batched(batch) for batch in batches),
+        *(review_file(file) for file in single)
+    )
+
+    for batch_reviews in results[:len(batches)]:
+        reviews.update(batch_reviews)
+    reviews.update(
+        (file["path"], body)
+        for file, body in zip(single, results[len(batches):])
+        if body is not None
+    )
+
+    for file in pending:
+        if file["path"] not in reviews:
+            continue
+        review_cache[file["key"]] = {
+            "body": reviews[file["path"]],
+            "expires": time.time() + REVIEW_CACHE_TTL
+        }
+    return reviews
+
+
+# --- POST REVIEW BACK TO THE PR ---
+# { "<head sha>:<path>": {review_id, expires} } — on a rerun for the same head
+# commit (CI retry, re-triggered workflow), files already reviewed are skipped
+# before any fetch or Gemini call, and no duplicate review is posted.
+POSTED_CACHE_PATH = os.path.join(CACHE_DIR, "posted.json")
+posted_reviews = {
+    key: entry
+    for key, entry in load_json_cache(POSTED_CACHE_PATH).items()
+    if entry.get("expires", 0) > now
 }
 
-for comment in review_comments:
-    body = f"**Review for file:** `{comment['path']}`\n\n{comment['body']}"
-    response = requests.post(COMMENTS_URL, headers=post_headers, json={"body": body})
+
+def posted_key(file_path):
+    return f"{PR_HEAD_SHA}:{file_path}"
+
+
+# All file reviews go out as one pull request review: one request and one
+# notification instead of one issue comment per file.
+def review_anchor(changes):
+    # Inline comments must point at a line inside the diff; use the last
+    # added line, or the last deleted one for deletion-only changes.
+    added = [c for c in changes if c.type == "added"]
+    if added:
+        return {"line": added[-1].new_line, "side": "RIGHT"}
+    return {"line": changes[-1].old_line, "side": "LEFT"}
+
+
+# Creating a review is not idempotent: a 5xx or read timeout may come after
+# GitHub already stored it, and a replay would post it twice. Only 429, which
+# means the request was refused, is retried for this endpoint.
+session.mount(REVIEWS_URL, HTTPAdapter(max_retries=Retry(
+    total=5,
+    read=0,
+    backoff_factor=0.5,
+    status_forcelist=[429],
+    allowed_methods=["POST"],
+    respect_retry_after_header=True,
+    raise_on_status=False
+)))
+
+
+def post_review(review_comments):
+    post_headers = {
+        "Authorization": f"token {GITHUB_TOKEN}",
+        "Accept": "application/vnd.github.v3+json",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "commit_id": PR_HEAD_SHA,
+        "event": "COMMENT",
+        "body": "Automated review",
+        "comments": [
+            {"path": comment["path"], "body": comment["body"], **review_anchor(pr_diff[comment["path"]])}
+            for comment in review_comments
+        ]
+    }
+    response = session.post(REVIEWS_URL, headers=post_headers, json=payload)
+    if response.status_code == 422:
+        # A line outside the PR diff rejects the whole review (e.g. a change
+        # already reverted later in the PR); post the reviews as the body instead.
+        print(f"Inline review rejected, posting as a single review body: {response.text}")
+        payload["body"] = "\n\n".join(
+            f"**Review for file:** `{comment['path']}`\n\n{comment['body']}"
+            for comment in review_comments
+        )
+        del payload["comments"]
+        response = session.post(REVIEWS_URL, headers=post_headers, json=payload)
     print(response.status_code, response.text)
+    if response.status_code == 200:
+        return response.json()["id"]
+    return None
+
+
+# Upper bound on concurrent HTTP calls, to stay under the per-minute API quotas.
+MAX_WORKERS = 8
+
+
+async def main():
+    # The HTTP calls are blocking, so each runs in a worker thread and the
+    # requests overlap instead of running one after another. asyncio.to_thread
+    # uses the loop's default executor, bounded here to MAX_WORKERS threads.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=MAX_WORKERS))
+    changed = {
+        file_path: changes
+        for file_path, changes in pr_diff.items()
+        if changes and not should_skip(file_path)
+    }
+    already_posted = [file_path for file_path in changed if posted_key(file_path) in posted_reviews]
+    for file_path in already_posted:
+        print(f"Already reviewed {file_path} at {PR_HEAD_SHA[:7]} — skipping.")
+        del changed[file_path]
+    base_contents = await load_base_contents([
+        file_path
+        for file_path, changes in changed.items()
+        if should_fetch_full(changes, pr_context[file_path])
+    ])
+    files = [
+        prepare_file(file_path, changes, base_contents.get(file_path), pr_context[file_path])
+        for file_path, changes in changed.items()
+    ]
+    try:
+        reviews = await review_files(files)
+    finally:
+        save_json_cache(REVIEW_CACHE_PATH, review_cache)
+        save_json_cache(ETAG_CACHE_PATH, etag_cache)
+
+    review_comments = [
+        {"path": file["path"], "body": reviews[file["path"]]}
+        for file in files
+        if file["path"] in reviews
+    ]
+    failed = False
+    if review_comments:
+        review_id = await asyncio.to_thread(post_review, review_comments)
+        if review_id is not None:
+            for comment in review_comments:
+                posted_reviews[posted_key(comment["path"])] = {
+                    "review_id": review_id,
+                    "expires": time.time() + REVIEW_CACHE_TTL
+                }
+            save_json_cache(POSTED_CACHE_PATH, posted_reviews)
+        else:
+            print("::error::Failed to post the pull request review.")
+            failed = True
+
+    # The reviews that succeeded are posted above; the job still fails so a
+    # partial (or empty) review is not mistaken for a clean one.
+    missing = [file["path"] for file in files if file["path"] not in reviews]
+    if missing:
+        print(f"::error::No review generated for {len(missing)} of {len(files)} files: {', '.join(missing)}")
+        failed = True
+    if failed:
+        exit(1)
+
+
+asyncio.run(main())